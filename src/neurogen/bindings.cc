@@ -1,15 +1,27 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
 #include "encoder.h"
 
 namespace py = pybind11;
 
+using uint32_array = py::array_t<std::uint32_t, py::array::c_style | py::array::forcecast>;
+
 PYBIND11_MODULE(backend, m) 
 {
     m.def("encode_mesh", [](
-        const std::vector<std::uint32_t>& vertices, 
-        const std::vector<std::uint32_t>& faces, 
+        const uint32_array& vertices, 
+        const uint32_array& faces, 
         int compression){
-            auto s = DracoFunctions::encode_mesh(vertices, faces, compression);
+            // Copy the array buffers directly rather than converting element by element
+            std::vector<std::uint32_t> vertex_data(vertices.data(), vertices.data() + vertices.size());
+            std::vector<std::uint32_t> face_data(faces.data(), faces.data() + faces.size());
+
+            std::string s;
+            {
+                // Allow fragments to be encoded concurrently from Python threads
+                py::gil_scoped_release release;
+                s = DracoFunctions::encode_mesh(vertex_data, face_data, compression);
+            }
             return py::bytes(s);
     });
 
@@ -40,10 +40,11 @@ def encode_vertices_faces(vertices, faces, compression_level):
         A bytes object containing the encoded mesh.
     """
 
-    return backend.encode_mesh(
-            vertices.flatten().astype(np.uint32), 
-            faces.flatten().astype(np.uint32),
-            compression_level)
+    # Only copies when the input is not already contiguous uint32
+    vertices = np.ascontiguousarray(vertices, dtype=np.uint32).ravel()
+    faces = np.ascontiguousarray(faces, dtype=np.uint32).ravel()
+
+    return backend.encode_mesh(vertices, faces, compression_level)
 
 def decode_buffer(buffer):
     """ Decodes Draco buffer into vertices and faces
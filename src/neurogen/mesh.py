@@ -1,6 +1,8 @@
 import trimesh
 import numpy as np
-import os, struct, json
+import os, io, struct, json
+import concurrent.futures
+import functools
 from neurogen import encoder
 
 
@@ -35,9 +37,11 @@ class Quantize():
         quantization_bits : int
             The number of bits to use for quantization.
         """
-        self.upper_bound = np.iinfo(np.uint32).max >> (np.dtype(np.uint32).itemsize*8 - quantization_bits)
-        self.scale = self.upper_bound / fragment_shape
-        self.offset = input_origin - fragment_origin + 0.5/self.scale
+        self.upper_bound = (1 << quantization_bits) - 1
+        scale = self.upper_bound / np.asarray(fragment_shape, dtype=np.float64)
+        offset = input_origin - np.asarray(fragment_origin, dtype=np.float64) + 0.5/scale
+        self.scale = np.ascontiguousarray(scale, dtype=np.float32)
+        self.offset = np.ascontiguousarray(offset, dtype=np.float64)
 
 
     def __call__(self, vertices):
@@ -51,31 +55,107 @@ class Quantize():
         Returns
         -------
         np.ndarray
-            Quantized vertex positions.
+            Quantized vertex positions as uint32.
         """
-        output = np.minimum(self.upper_bound, np.maximum(0, self.scale*(vertices + self.offset))).astype(np.uint32)
-        return output
+        # The offset is applied in float64 so that large vertex positions keep
+        # their fractional bits; only the result relative to the fragment is
+        # narrowed to float32 before it is scaled and clamped in place
+        output = np.add(vertices, self.offset).astype(np.float32)
+        output *= self.scale
+        np.clip(output, 0, self.upper_bound, out=output)
+        return output.astype(np.uint32)
 
 
-def cmp_zorder(lhs, rhs):
-    """Compare z-ordering
+    @staticmethod
+    def quantize_unit_cell(vertices, origin, upper_bound):
+        """ Quantizes vertex positions within a unit cell.
+
+        Equivalent to calling a Quantize with `fragment_origin=origin`,
+        `fragment_shape=[1,1,1]` and `input_origin=[0,0,0]`, without building
+        the per-fragment scale and offset arrays.
+
+        Parameters
+        ----------
+        vertices : np.ndarray
+            Nx3 numpy array of vertex positions.
+        origin : array_like
+            Minimum vertex position of the unit cell.
+        upper_bound : int
+            The largest integer used to represent a vertex position.
+
+        Returns
+        -------
+        np.ndarray
+            Quantized vertex positions as uint32.
+        """
+        # Same arithmetic as Quantize: the origin is subtracted in float64 so that
+        # cells far from the grid origin keep their fractional bits
+        offset = 0.5/upper_bound - np.asarray(origin, dtype=np.float64)
+        output = np.add(vertices, offset).astype(np.float32)
+        output *= np.float32(upper_bound)
+        np.clip(output, 0, upper_bound, out=output)
+        return output.astype(np.uint32)
+
+
+def morton3d(x, y, z):
+    """Computes the 3D Morton (z-order) code of integer coordinates
     
-    Code taken from https://en.wikipedia.org/wiki/Z-order_curve
+    The bits of each coordinate are dilated with the shift/mask sequence from
+    https://en.wikipedia.org/wiki/Z-order_curve so that sorting by the returned
+    code visits the coordinates in z-order, with z as the most significant
+    dimension. Up to 21 bits per coordinate are supported.
+
+    Parameters
+    ----------
+    x, y, z : array_like
+        Non-negative integer coordinates along each dimension.
+
+    Returns
+    -------
+    np.ndarray
+        uint64 array of Morton codes.
+    """
+    def dilate(v):
+        v = np.asarray(v).astype(np.uint64) & np.uint64(0x1FFFFF)
+        v = (v | (v << np.uint64(32))) & np.uint64(0x1F00000000FFFF)
+        v = (v | (v << np.uint64(16))) & np.uint64(0x1F0000FF0000FF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+        return v
+
+    return dilate(x) | (dilate(y) << np.uint64(1)) | (dilate(z) << np.uint64(2))
+
+
+@functools.lru_cache(maxsize=8)
+def zorder_grid(nodes_per_dim):
+    """Lists the cells of a cubic grid in z-curve order
+
+    The result only depends on the grid size, so the most recently used grid
+    sizes (enough for the LODs of a typical mesh) are cached and shared
+    across LODs and segments.
+
+    Parameters
+    ----------
+    nodes_per_dim : int
+        Number of cells along each dimension
+
+    Returns
+    -------
+    positions : np.ndarray
+        Read-only 3xN '<u4' array of cell positions, one row per dimension.
+    codes : np.ndarray
+        Read-only array of the sorted Morton codes of the positions.
     """
-    def less_msb(x: int, y: int):
-        return x < y and x < (x ^ y)
-
-    # Assume lhs and rhs array-like objects of indices.
-    assert len(lhs) == len(rhs)
-    # Will contain the most significant dimension.
-    msd = 2
-    # Loop over the other dimensions.
-    for dim in [1, 0]:
-        # Check if the current dimension is more significant
-        # by comparing the most significant bits.
-        if less_msb(lhs[msd] ^ rhs[msd], lhs[dim] ^ rhs[dim]):
-            msd = dim
-    return lhs[msd] - rhs[msd]
+    positions = np.indices((nodes_per_dim,)*3, dtype='<u4').reshape(3, -1)
+    codes = morton3d(*positions)
+    order = np.argsort(codes)
+    positions = positions[:, order]
+    codes = codes[order]
+    positions.setflags(write=False)
+    codes.setflags(write=False)
+
+    return positions, codes
 
 
 def clean_mesh(mesh):
@@ -96,7 +176,25 @@ def clean_mesh(mesh):
     return mesh
 
 
-def scale_mesh(mesh, scale):
+def clean_mesh_lod(mesh):
+    """This function cleans up a decimated mesh before it is fragmented.
+
+    Quadric decimation does not introduce holes or infinite values, and
+    unreferenced vertices are dropped when the mesh is bucketized, so only
+    degenerate faces need to be removed before encoding.
+    
+    Returns
+    -------
+    mesh : trimesh.base.Trimesh
+        A mesh without degenerate faces
+    """
+
+    mesh.remove_degenerate_faces()
+
+    return mesh
+
+
+def scale_mesh(mesh, scale, bounds=None):
     """ This function scales the vertices to range from 0 to scale 
     
     Parameters
@@ -105,6 +203,9 @@ def scale_mesh(mesh, scale):
         A Trimesh mesh object to scale
     scale : int
         Specifies the max for the new range
+    bounds : tuple of np.ndarray, optional
+        Minimum and maximum vertex positions mapped to 0 and scale. Defaults to
+        the bounds of the mesh vertices.
     
     Returns
     -------
@@ -113,17 +214,110 @@ def scale_mesh(mesh, scale):
     """
 
     vertices = mesh.vertices
-    maxval = vertices.max(axis=0)
-    minval = vertices.min(axis=0)
+    if bounds is None:
+        minval = vertices.min(axis=0)
+        maxval = vertices.max(axis=0)
+    else:
+        minval, maxval = bounds
 
     max_nodes = scale/(maxval-minval)
-    verts_scaled = max_nodes*(vertices - minval)
-    scaled_mesh = mesh.copy()
-    scaled_mesh.vertices = verts_scaled
+    verts_scaled = np.subtract(vertices, minval)
+    verts_scaled *= max_nodes
+
+    # Faces are shared with the input mesh rather than deep-copied
+    scaled_mesh = trimesh.Trimesh(vertices=verts_scaled, faces=mesh.faces, process=False)
 
     return scaled_mesh
 
 
+def bucketize_mesh(mesh, nodes_per_dim):
+    """ Splits a scaled mesh into fragments along a regular grid of unit cells
+
+    Faces spanning several cells are cut along the integer planes they cross,
+    after which every face lies inside a single cell and is assigned to it by
+    its centroid. This replaces slicing the whole mesh with six planes for
+    every cell.
+
+    Parameters
+    ----------
+    mesh : trimesh.base.Trimesh
+        A Trimesh mesh object whose vertices range from 0 to nodes_per_dim
+    nodes_per_dim : int
+        Number of cells along each dimension
+
+    Returns
+    -------
+    fragments : dict
+        Maps the (x, y, z) index of every non-empty cell to a tuple of the
+        fragment's vertices and faces.
+    """
+
+    vertices = mesh.vertices
+    faces = mesh.faces
+
+    # Faces whose vertices all fall in the same cell need no cutting, so only
+    # the faces spanning several cells are cut, on a compacted copy of the mesh
+    vertex_cells = np.clip(np.floor(vertices), 0, nodes_per_dim - 1).astype(np.int32)[faces]
+    spanning = (vertex_cells.min(axis=1) != vertex_cells.max(axis=1)).any(axis=1)
+    indices, inverse = np.unique(faces[spanning], return_inverse=True)
+    cut_vertices = vertices[indices]
+    cut_faces = inverse.reshape(-1, 3)
+
+    # Cut the faces crossing each interior plane into the parts on either side
+    for axis, normal in enumerate(np.eye(3)):
+        for plane in range(1, nodes_per_dim):
+            coords = cut_vertices[cut_faces, axis]
+            crossing = (coords.min(axis=1) < plane) & (coords.max(axis=1) > plane)
+            if not crossing.any():
+                continue
+
+            crossing_mesh = trimesh.Trimesh(vertices=cut_vertices, faces=cut_faces[crossing], process=False)
+            below = trimesh.intersections.slice_mesh_plane(crossing_mesh, plane_normal=-normal, plane_origin=normal*plane)
+            above = trimesh.intersections.slice_mesh_plane(crossing_mesh, plane_normal=normal, plane_origin=normal*plane)
+
+            cut_faces = np.concatenate([cut_faces[~crossing],
+                                        below.faces + len(cut_vertices),
+                                        above.faces + len(cut_vertices) + len(below.vertices)])
+            cut_vertices = np.concatenate([cut_vertices, below.vertices, above.vertices])
+
+    # The slices return copies of the vertices they keep, so merge every cut
+    # vertex onto the first one at the same position; original corners map
+    # back to the vertex that the uncut faces already reference
+    cut_vertices, first, inverse = np.unique(cut_vertices, axis=0, return_index=True, return_inverse=True)
+    added = first >= len(indices)
+    remap = np.empty(len(cut_vertices), dtype=np.int64)
+    remap[~added] = indices[first[~added]]
+    remap[added] = len(vertices) + np.arange(np.count_nonzero(added))
+    faces = np.concatenate([faces[~spanning], remap[inverse.reshape(-1)][cut_faces]])
+    vertices = np.concatenate([vertices, cut_vertices[added]])
+
+    # Group the faces by the cell containing their centroid
+    cells = np.floor(vertices[faces].mean(axis=1)).astype(np.int64)
+    np.clip(cells, 0, nodes_per_dim - 1, out=cells)
+    keys = (cells[:, 0]*nodes_per_dim + cells[:, 1])*nodes_per_dim + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    faces = faces[order]
+    cell_keys, face_starts = np.unique(keys, return_index=True)
+    face_ends = np.append(face_starts[1:], len(faces))
+
+    # Remap all fragments onto their own vertices at once: every (cell, vertex)
+    # pair becomes one fragment vertex, and each cell's pairs are contiguous
+    num_vertices = len(vertices)
+    cell_vertices, inverse = np.unique((keys[:, None]*num_vertices + faces).ravel(), return_inverse=True)
+    vertex_starts = np.searchsorted(cell_vertices, cell_keys*num_vertices)
+    vertex_ends = np.append(vertex_starts[1:], len(cell_vertices))
+    fragment_vertices = vertices[cell_vertices % num_vertices]
+    fragment_faces = inverse.reshape(-1, 3) - np.repeat(vertex_starts, face_ends - face_starts)[:, None]
+
+    fragments = {}
+    for key, vstart, vend, fstart, fend in zip(cell_keys, vertex_starts, vertex_ends, face_starts, face_ends):
+        cell = tuple(int(c) for c in np.unravel_index(key, (nodes_per_dim,)*3))
+        fragments[cell] = (fragment_vertices[vstart:vend], fragment_faces[fstart:fend])
+
+    return fragments
+
+
 def fulloctree_decomposition(vertices,
                             faces,
                             num_lods, 
@@ -190,7 +384,8 @@ def fulloctree_decomposition_mesh(mesh,
     mesh_subdirectory : str
         Name of the mesh subdirectory within the Neuroglancer volume directory.
     """
-    assert (quantization_bits == 10) or (quantization_bits == 16)
+    if quantization_bits not in (10, 16):
+        raise ValueError(f'quantization_bits must be 10 or 16, got {quantization_bits}')
 
     # Mesh values
     mesh_vertices = mesh.vertices
@@ -199,14 +394,16 @@ def fulloctree_decomposition_mesh(mesh,
     clean_mesh(mesh)
 
     # Initialize Arrays used to define the decomposition
-    lods = np.arange(0, num_lods)
-    scales = np.power(2, lods)
+    lods = np.arange(0, num_lods, dtype=np.int64)
+    scales = 1 << lods
 
     # For each LOD, define how much the mesh is going to be simplified 
-        # by reducing the number of faces
-    decimate_by = np.power(np.true_divide(num_lods,scales),2)
+        # by reducing the number of faces, i.e. by (num_lods/scale)**2
     num_faces = mesh.faces.shape[0] 
-    num_faces_left = num_faces//decimate_by
+    num_faces_left = [max(4, (num_faces*int(scale)**2)//(num_lods**2)) for scale in scales]
+
+    # Every fragment is quantized relative to a unit cell
+    upper_bound = (1 << quantization_bits) - 1
 
     # Create directory
     mesh_dir = os.path.join(directory, mesh_subdirectory)
@@ -216,67 +413,68 @@ def fulloctree_decomposition_mesh(mesh,
     # https://github.com/google/neuroglancer/blob/master/src/neuroglancer/datasource/precomputed/meshes.md
     chunk_shape = (max_mesh_vertex - min_mesh_vertex)/(num_lods)
     grid_origin = min_mesh_vertex
-    vertex_offsets = np.array([[0., 0., 0.] for _ in range(num_lods)])
-    num_fragments_per_lod = np.flip(np.power(8, lods))
+    vertex_offsets = np.zeros((num_lods, 3), dtype='<f4')
+    num_fragments_per_lod = np.flip(1 << (3*lods))
     manifest_filename = os.path.join(mesh_dir, f'{segment_id}.index')
-    with open(manifest_filename, 'ab') as manifest_file:
-        manifest_file.write(chunk_shape.astype('<f').tobytes())
-        manifest_file.write(grid_origin.astype('<f').tobytes())
-        manifest_file.write(struct.pack('<I', num_lods))
-        manifest_file.write(scales.astype('<f').tobytes())
-        manifest_file.write(vertex_offsets.astype('<f').tobytes(order='C'))
-        manifest_file.write(num_fragments_per_lod.astype('<I').tobytes())
-
-        # Write fragment file
-        with open(os.path.join(mesh_dir, f'{segment_id}'), 'wb') as fragment_file:
-            
-            for i in reversed(lods):
-
-                decimated_mesh = mesh.simplify_quadratic_decimation(num_faces_left[i])
-                clean_mesh(decimated_mesh)
-
-                nodes_per_dim = scales[i]
-
-                # The vertices need to range from 0 to number of nodes in mesh
-                scaled_mesh = scale_mesh(decimated_mesh, nodes_per_dim)
-
-                # Define plane normals and scale mesh.
-                nyz, nxz, nxy = np.eye(3)
-
-                # Variables that will be appended to the manifest file
-                lod_pos = []
-                lod_off = []
-
-                # The mesh gets sliced at every node
-                for x in range(0, nodes_per_dim):
-                    mesh_x = trimesh.intersections.slice_mesh_plane(scaled_mesh, plane_normal=nyz, plane_origin=nyz*x)
-                    mesh_x = trimesh.intersections.slice_mesh_plane(mesh_x, plane_normal=-nyz, plane_origin=nyz*(x+1))
-                    for y in range(0, nodes_per_dim):
-                        mesh_y = trimesh.intersections.slice_mesh_plane(mesh_x, plane_normal=nxz, plane_origin=nxz*y)
-                        mesh_y = trimesh.intersections.slice_mesh_plane(mesh_y, plane_normal=-nxz, plane_origin=nxz*(y+1))
-                        for z in range(0, nodes_per_dim):
-                            mesh_z = trimesh.intersections.slice_mesh_plane(mesh_y, plane_normal=nxy, plane_origin=nxy*z)
-                            mesh_z = trimesh.intersections.slice_mesh_plane(mesh_z, plane_normal=-nxy, plane_origin=nxy*(z+1))
-
-                            # Initialize Quantizer.
-                            quantizer = Quantize(
-                                fragment_origin=np.array([x, y, z]), 
-                                fragment_shape=np.array([1, 1, 1]), 
-                                input_origin=np.array([0,0,0]), 
-                                quantization_bits=quantization_bits
-                            )
-
-                            dracolen = 0
-                            if len(mesh_z.vertices) > 0:
-                                mesh_z.vertices = quantizer(mesh_z.vertices)
-                                draco = encoder.encode_mesh(mesh_z,compression_level=compression_level)
-                                
-                                dracolen = len(draco)
-                                fragment_file.write(draco)
-
-
-                            lod_off.append(dracolen)
-                            lod_pos.append([x, y, z])
-
-                manifest_file.write(np.array(lod_pos).T.astype('<I').tobytes(order='C'))
-                manifest_file.write(np.array(lod_off).astype('<I').tobytes(order='C'))
\ No newline at end of file
+    manifest = io.BytesIO()
+
+    # Pack the scalar header with one struct call and the per-LOD arrays with one
+    # copy; the fragment counts are reinterpreted as '<f4' so they share the buffer
+    header = struct.pack('<3f3fI', *chunk_shape, *grid_origin, num_lods)
+    lod_header = np.concatenate([scales.astype('<f4'),
+                                 vertex_offsets.ravel(),
+                                 num_fragments_per_lod.astype('<u4').view('<f4')])
+    manifest.write(header + lod_header.tobytes())
+
+    # Write fragment file next to the existing one, buffering the manifest
+    # until all LODs are done
+    fragment_filename = os.path.join(mesh_dir, f'{segment_id}')
+    fragment_tmp = fragment_filename + '.tmp'
+    with open(fragment_tmp, 'wb') as fragment_file, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        
+        # Each LOD is decimated further from the previous, finer LOD
+        decimated_mesh = mesh
+        for i in reversed(lods):
+
+            decimated_mesh = decimated_mesh.simplify_quadratic_decimation(num_faces_left[i])
+            clean_mesh_lod(decimated_mesh)
+
+            nodes_per_dim = scales[i]
+
+            # The vertices need to range from 0 to number of nodes in mesh,
+            # measured on the same grid as the manifest
+            scaled_mesh = scale_mesh(decimated_mesh, nodes_per_dim, bounds=(min_mesh_vertex, max_mesh_vertex))
+
+            fragments = bucketize_mesh(scaled_mesh, nodes_per_dim)
+
+            # Draco encoding releases the GIL, so the fragments are encoded concurrently
+            def encode_fragment(cell):
+                fragment_vertices, fragment_faces = fragments[cell]
+                quantized_vertices = Quantize.quantize_unit_cell(fragment_vertices, cell, upper_bound)
+                return encoder.encode_vertices_faces(quantized_vertices,
+                                                     fragment_faces,
+                                                     compression_level=compression_level)
+
+            encoded = dict(zip(fragments, executor.map(encode_fragment, fragments)))
+
+            # Fragments are stored in z-curve order as required by the specification,
+            # with the positions stored one row per dimension
+            lod_pos, grid_codes = zorder_grid(nodes_per_dim)
+
+            cells = list(encoded)
+            cell_codes = morton3d(*np.reshape(cells, (-1, 3)).T)
+            lod_off = np.zeros(nodes_per_dim**3, dtype='<u4')
+            lod_off[np.searchsorted(grid_codes, cell_codes)] = np.fromiter(map(len, encoded.values()), dtype='<u4', count=len(encoded))
+
+            # Write each LOD with a single call per file
+            fragment_file.write(b''.join(encoded[cells[k]] for k in np.argsort(cell_codes)))
+            manifest.write(lod_pos.tobytes() + lod_off.tobytes())
+
+    # Only replace the previous files once every LOD has been generated, so a
+    # failure partway through leaves the previous segment intact
+    manifest_tmp = manifest_filename + '.tmp'
+    with open(manifest_tmp, 'wb') as manifest_file:
+        manifest_file.write(manifest.getbuffer())
+    os.replace(fragment_tmp, fragment_filename)
+    os.replace(manifest_tmp, manifest_filename)
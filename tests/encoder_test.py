@@ -4,6 +4,9 @@ import numpy as np
 import math
 import tempfile
 import struct
+import concurrent.futures
+import trimesh
+from unittest import mock
 
 from neurogen import encoder
 from neurogen import mesh as ngmesh
@@ -29,6 +32,16 @@ class TestEncodingDecoding(unittest.TestCase):
             )
         )
     
+    def test_encode_from_threads(self):
+        vertices = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_vertices.npy')).astype(np.int64)
+        faces = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_faces.npy')).astype(np.int64)
+
+        # The backend releases the GIL while encoding, so it is called concurrently
+        expected = encoder.encode_vertices_faces(vertices, faces, compression_level=5)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            buffers = list(executor.map(lambda _: encoder.encode_vertices_faces(vertices, faces, compression_level=5), range(8)))
+        self.assertTrue(all(buffer == expected for buffer in buffers))
+
     def test_info_file_specification(self):
         size, radius = 100, 20
         volume = np.zeros((size,size,size)).astype('uint8')
@@ -89,11 +102,13 @@ class TestEncodingDecoding(unittest.TestCase):
         # temp_dir = tempfile.TemporaryDirectory()
         with tempfile.TemporaryDirectory() as temp_dir:
             offset_check = 0
-            ngmesh.fulloctree_decomposition(vertices=vertices, 
-                                          faces=faces, 
-                                          num_lods=3, 
-                                          segment_id=1, 
-                                          directory=str(temp_dir))
+            # Regenerating a segment must overwrite, not append to, its files
+            for _ in range(2):
+                ngmesh.fulloctree_decomposition(vertices=vertices, 
+                                              faces=faces, 
+                                              num_lods=3, 
+                                              segment_id=1, 
+                                              directory=str(temp_dir))
             
             manifest = os.path.join(temp_dir, "meshdir", "1.index")
             eof = os.path.getsize(manifest)
@@ -118,6 +133,8 @@ class TestEncodingDecoding(unittest.TestCase):
                     fragment_positions_y = list(struct.unpack_from("<" + str(frags_inthisLOD) + "I", manifest_file.read(frags_inthisLOD*4)))
                     fragment_positions_z = list(struct.unpack_from("<" + str(frags_inthisLOD) + "I", manifest_file.read(frags_inthisLOD*4)))
                     fragment_offsets = list(struct.unpack_from("<" + str(frags_inthisLOD)+"I", manifest_file.read(frags_inthisLOD*4)))
+                    fragment_codes = ngmesh.morton3d(fragment_positions_x, fragment_positions_y, fragment_positions_z)
+                    self.assertTrue((np.diff(fragment_codes.astype(np.int64)) > 0).all())
                     offset_check = offset_check + sum(fragment_offsets)
 
                 self.assertTrue(eof==manifest_file.tell())
@@ -126,6 +143,112 @@ class TestEncodingDecoding(unittest.TestCase):
             fragment_file_size = os.path.getsize(fragment)
             self.assertTrue(offset_check==fragment_file_size)
 
+    def test_failed_regeneration_keeps_previous_mesh(self):
+        vertices = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_vertices.npy')).astype(np.uint32)
+        faces = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_faces.npy')).astype(np.uint32)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ngmesh.fulloctree_decomposition(vertices=vertices,
+                                            faces=faces,
+                                            num_lods=3,
+                                            segment_id=1,
+                                            directory=str(temp_dir))
+
+            manifest = os.path.join(temp_dir, "meshdir", "1.index")
+            fragment = os.path.join(temp_dir, "meshdir", "1")
+            with open(manifest, 'rb') as f:
+                manifest_bytes = f.read()
+            with open(fragment, 'rb') as f:
+                fragment_bytes = f.read()
+
+            # Fail on the second LOD, after the first one has been written
+            bucketize_mesh = ngmesh.bucketize_mesh
+            calls = []
+            def failing_bucketize_mesh(*args, **kwargs):
+                calls.append(None)
+                if len(calls) == 2:
+                    raise RuntimeError("bucketization failed")
+                return bucketize_mesh(*args, **kwargs)
+
+            with mock.patch.object(ngmesh, 'bucketize_mesh', failing_bucketize_mesh):
+                with self.assertRaises(RuntimeError):
+                    ngmesh.fulloctree_decomposition(vertices=vertices,
+                                                    faces=faces,
+                                                    num_lods=3,
+                                                    segment_id=1,
+                                                    directory=str(temp_dir))
+
+            with open(manifest, 'rb') as f:
+                self.assertTrue(f.read() == manifest_bytes)
+            with open(fragment, 'rb') as f:
+                self.assertTrue(f.read() == fragment_bytes)
+
+    def test_invalid_quantization_bits(self):
+        vertices = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_vertices.npy')).astype(np.uint32)
+        faces = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_faces.npy')).astype(np.uint32)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaises(ValueError):
+                ngmesh.fulloctree_decomposition(vertices=vertices,
+                                                faces=faces,
+                                                num_lods=1,
+                                                segment_id=1,
+                                                directory=str(temp_dir),
+                                                quantization_bits=12)
+
+    def test_mesh_bucketization(self):
+        vertices = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_vertices.npy'))
+        faces = np.loadtxt(os.path.join(dir_path, 'test_data/sphere_faces.npy')).astype(np.uint32)
+        scaled_mesh = ngmesh.scale_mesh(trimesh.Trimesh(vertices=vertices, faces=faces), 4)
+
+        fragments = ngmesh.bucketize_mesh(scaled_mesh, 4)
+
+        total_area = 0
+        for (x, y, z), (fragment_vertices, fragment_faces) in fragments.items():
+            tol = 1e-6
+            self.assertTrue((fragment_vertices >= np.array([x, y, z]) - tol).all())
+            self.assertTrue((fragment_vertices <= np.array([x, y, z]) + 1 + tol).all())
+            self.assertTrue(len(np.unique(fragment_vertices, axis=0)) == len(fragment_vertices))
+            total_area += trimesh.Trimesh(vertices=fragment_vertices, faces=fragment_faces, process=False).area
+        self.assertTrue(np.isclose(total_area, scaled_mesh.area))
+
+    def test_quantize_unit_cell(self):
+        rng = np.random.default_rng(0)
+        for quantization_bits in (10, 16):
+            upper_bound = (1 << quantization_bits) - 1
+            origin = np.array([511, 300, 7])
+            vertices = origin + rng.uniform(0, 1, size=(10000, 3))
+
+            quantizer = ngmesh.Quantize(fragment_origin=origin,
+                                        fragment_shape=np.array([1, 1, 1]),
+                                        input_origin=np.array([0, 0, 0]),
+                                        quantization_bits=quantization_bits)
+            expected = quantizer(vertices).astype(np.int64)
+            quantized = ngmesh.Quantize.quantize_unit_cell(vertices, tuple(origin), upper_bound).astype(np.int64)
+            self.assertTrue((quantized == expected).all())
+
+            # Both stay within rounding of the float64 formula far from the grid origin
+            exact = np.clip(upper_bound*(vertices - origin) + 0.5, 0, upper_bound).astype(np.int64)
+            self.assertTrue((np.abs(quantized - exact) <= 1).all())
+
+    def test_morton_order(self):
+        coords = np.random.default_rng(0).integers(0, 2**21, size=(1000, 3))
+        codes = ngmesh.morton3d(coords[:,0], coords[:,1], coords[:,2])
+
+        for (x, y, z), code in zip(coords, codes):
+            expected = 0
+            for bit in range(21):
+                expected |= ((int(x) >> bit) & 1) << (3*bit)
+                expected |= ((int(y) >> bit) & 1) << (3*bit + 1)
+                expected |= ((int(z) >> bit) & 1) << (3*bit + 2)
+            self.assertTrue(int(code) == expected)
+
+        # The first octant is traversed completely before moving on
+        x, y, z = np.meshgrid(np.arange(4), np.arange(4), np.arange(4), indexing='ij')
+        order = np.argsort(ngmesh.morton3d(x.ravel(), y.ravel(), z.ravel()))
+        first_octant = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)[order[:8]]
+        self.assertTrue((first_octant < 2).all())
+
 
 
 if __name__ == '__main__':